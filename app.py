@@ -1,12 +1,35 @@
+from __future__ import annotations
+
+import asyncio
+import base64
+import functools
+import gc as _gc
+import gzip
+import hashlib
 import os
-import textwrap
-from datetime import datetime
+import pickle
+import re
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import TYPE_CHECKING, Final
+from urllib.parse import quote
 
 import streamlit as st
-from huggingface_hub import InferenceClient
 
-import gspread
-from google.oauth2.service_account import Credentials
+import orjson
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_exponential
+
+# huggingface_hub, gspread and google-auth are imported lazily (see LAZY IMPORTS).
+if TYPE_CHECKING:
+    import gspread
+    from google.auth.transport.requests import AuthorizedSession
 
 
 # ---------------------------
@@ -16,86 +39,813 @@ from google.oauth2.service_account import Credentials
 # Hugging Face model (supports chat / conversational)
 MODEL_ID = "mistralai/Mistral-7B-Instruct-v0.3"
 
+# The 5–7 bullet employer summary doesn't need the 7B model.
+SUMMARY_MODEL_ID = "Qwen/Qwen2.5-3B-Instruct"
+
+# Short prompts / small budgets go to a smaller, faster model.
+MODEL_ID_DEEP = MODEL_ID
+MODEL_ID_FAST = SUMMARY_MODEL_ID
+HF_MODELS = (MODEL_ID_FAST, MODEL_ID_DEEP)
+FAST_MAX_NEW_TOKENS = 200
+FAST_MAX_PROMPT_CHARS = 1500
+
+# "true" is already the HF Inference default; sent only to make the cache use
+# explicit. The saving comes from the static-prefix-first prompt layout.
+HF_HEADERS = {"X-use-cache": "true"}
+# Fail a stuck request instead of holding the Streamlit script thread forever.
+HF_TIMEOUT_S = 30
+
+# System prompts are static module-level strings: nothing in them depends on
+# the inputs, so a click only fills the {fields} of the user prompt templates.
+SYSTEM_PROMPT_JOBPOST: Final[str] = (
+    "Ты — помощник по созданию вакансий для рабочих (blue-collar) в Германии. "
+    "Ты пишешь объявления в дружелюбном, понятном стиле на РУССКОМ языке. "
+    "Используй эмодзи для структурирования текста, как в объявлениях в Telegram/WhatsApp.\n\n"
+    "Правила:\n"
+    "- Пиши коротко и по делу, без лишней рекламы.\n"
+    "- Делай чёткие блоки: должность, оплата, график, требования, документы, обязанности, начало работы.\n"
+    "- В конце всегда добавляй понятный призыв к действию (заполнить форму / написать в WhatsApp).\n"
+    "- Сохраняй профессиональный, но простой стиль для русскоязычных работников."
+)
+
+SYSTEM_PROMPT_SUMMARY: Final[str] = (
+    "You create concise professional summaries for internal use by employers "
+    "and project managers. You highlight key points and avoid marketing fluff. "
+    "You may mix Russian and English if helpful."
+)
+
+# Research tab: one system prompt per request type (keys are the selectbox options).
+SYSTEM_PROMPTS_RESEARCH: Final[dict[str, str]] = {
+    "Интерпретация метрик / таблиц": (
+        "Ты — аналитик по маркетингу и рекрутингу для платформы по найму рабочих. "
+        "Ты интерпретируешь KPI, варианты объявлений и результаты по регионам. "
+        "Отвечай кратко и по-русски, давай только практические выводы."
+    ),
+    "Сравнение регионов / платформ": (
+        "Ты — эксперт по каналам трафика и географии. "
+        "Сравниваешь города/регионы и платформы (Facebook, Instagram, Telegram, WhatsApp, job boards) "
+        "с точки зрения трафика и откликов. Отвечай по-русски."
+    ),
+    "Общий вопрос по стратегии / трафику": (
+        "Ты — стратег по перформанс-маркетингу в рекрутинге. "
+        "Отвечай по-русски, давай конкретные шаги и рекомендации."
+    ),
+}
+
 # Google Sheets
 SPREADSHEET_NAME = "AI_Campaign_Control"
 JOBPOSTS_SHEET = "JobPosts"
 RESEARCH_SHEET = "ResearchInsights"
+# Header row written when the app creates a worksheet.
+SHEET_HEADERS: Final[dict[str, list[str]]] = {
+    JOBPOSTS_SHEET: [
+        "timestamp",
+        "job_title",
+        "city",
+        "platform",
+        "variant_label",
+        "target_audience",
+        "application_link",
+        "generated_post",
+        "generated_post_b64",
+    ],
+    # *_b64 columns are appended at the end so older sheets keep their layout.
+    RESEARCH_SHEET: [
+        "timestamp",
+        "question_type",
+        "input_text",
+        "insights",
+        "insights_b64",
+        "input_text_b64",
+    ],
+}
 
 # Secrets (set in Streamlit Cloud → Settings → Secrets)
 HF_TOKEN = st.secrets.get("HF_TOKEN", os.getenv("HUGGINGFACEHUB_API_TOKEN"))
 GCP_SERVICE_ACCOUNT = st.secrets.get("gcp_service_account", None)
+# Optional: spreadsheet ID from its URL. Opening by key skips the Drive search by title.
+SPREADSHEET_KEY = st.secrets.get("spreadsheet_key", None)
+# Optional OpenAI-compatible Batch API (Together, Fireworks, ...) for research
+# queries that can wait: about half the price and outside the real-time rate limits.
+BATCH_API_BASE = st.secrets.get("batch_api_base", None)  # e.g. "https://api.together.xyz/v1"
+BATCH_API_KEY = st.secrets.get("batch_api_key", None)
+BATCH_MODEL_ID = st.secrets.get("batch_model_id", MODEL_ID)
+
+
+# ---------------------------
+# LAZY IMPORTS
+# ---------------------------
+# These libraries are slow to import and not needed on every code path
+# (e.g. gspread when Sheets is not configured), so a cold start skips them.
+
+@functools.lru_cache(maxsize=1)
+def _hf():
+    """huggingface_hub, imported on first model call."""
+    import huggingface_hub
+
+    return huggingface_hub
+
+
+@functools.lru_cache(maxsize=1)
+def _gspread():
+    """gspread, imported on first Sheets access."""
+    import gspread
+
+    return gspread
 
 
 # ---------------------------
 # HUGGING FACE CLIENT (CHAT COMPLETION)
 # ---------------------------
 
-@st.cache_resource(show_spinner=False)
-def get_hf_client():
-    """Create HF InferenceClient if token is set."""
-    if not HF_TOKEN:
-        return None
+def _release_client(client):
+    """on_release hook for cached clients: close the HTTP session they own."""
+    if client is None:
+        return
+    close = getattr(client, "close", None)
+    if callable(close):
+        close()
+        return
+    # gspread 5 keeps the session on the client, gspread 6 on client.http_client.
+    owner = getattr(client, "http_client", client)
+    session = getattr(owner, "session", None)
+    if session is not None:
+        session.close()
+
+
+def get_hf_client(model_id: str = MODEL_ID):
+    """
+    HF InferenceClient for model_id, created once per user session.
+
+    Kept in st.session_state rather than st.cache_resource so concurrent users
+    don't share one connection pool. Returns None if HF_TOKEN is not set.
+    """
+    clients = st.session_state.setdefault("hf_clients", {})
+    if model_id not in clients:
+        try:
+            clients[model_id] = (
+                _hf().InferenceClient(
+                    model_id, token=HF_TOKEN, headers=HF_HEADERS, timeout=HF_TIMEOUT_S
+                )
+                if HF_TOKEN
+                else None
+            )
+        except Exception:
+            clients[model_id] = None
+    return clients[model_id]
+
+
+def pick_model(user_prompt: str, max_new_tokens: int) -> str:
+    """Route short prompts or small budgets to the fast model, the rest to the deep one."""
+    if max_new_tokens <= FAST_MAX_NEW_TOKENS or len(user_prompt) < FAST_MAX_PROMPT_CHARS:
+        return MODEL_ID_FAST
+    return MODEL_ID_DEEP
+
+
+MODEL_NOT_CONFIGURED = "⚠️ Модель не настроена. Проверьте HF_TOKEN в secrets."
+
+# Sampling parameters are fixed so they don't need to be part of the cache key.
+TEMPERATURE = 0.7
+TOP_P = 0.95
+
+
+# Rate limits and overloaded backends (HF Inference and Sheets alike) are
+# retried with exponential backoff: 1 s, 2 s, 4 s, then the error is raised.
+TRANSIENT_STATUS = {429, 500, 502, 503, 504}
+
+
+@functools.lru_cache(maxsize=1)
+def _network_errors() -> tuple[type[BaseException], ...]:
+    """
+    Connection/timeout exception classes of every HTTP stack in use.
+
+    Sheets goes through requests; huggingface_hub uses httpx (aiohttp for the
+    async client in older releases), whose errors don't subclass requests'.
+    """
+    errors: list[type[BaseException]] = [
+        requests.ConnectionError,
+        requests.Timeout,
+        TimeoutError,
+    ]
     try:
-        return InferenceClient(MODEL_ID, token=HF_TOKEN)
-    except Exception:
-        return None
+        import httpx
+    except ImportError:
+        pass
+    else:
+        # TimeoutException (ConnectTimeout, ReadTimeout, ...) is a TransportError.
+        errors.append(httpx.TransportError)
+    try:
+        import aiohttp
+    except ImportError:
+        pass
+    else:
+        errors.append(aiohttp.ClientConnectionError)
+    return tuple(errors)
+
+
+def _is_transient(exc: BaseException) -> bool:
+    """True for errors worth retrying: connection problems and 429/5xx responses."""
+    if isinstance(exc, _network_errors()):
+        return True
+    response = getattr(exc, "response", None)
+    return getattr(response, "status_code", None) in TRANSIENT_STATUS
+
+
+retry_transient = retry(
+    retry=retry_if_exception(_is_transient),
+    stop=stop_after_attempt(4),
+    wait=wait_exponential(multiplier=1, min=1, max=16),
+    reraise=True,
+)
+
 
+class _CacheMiss(Exception):
+    """Raised by _cached_chat when no response is stored for the prompt yet."""
 
-def call_model(system_prompt: str, user_prompt: str, max_new_tokens: int = 512) -> str:
+
+@st.cache_data(ttl=24 * 60 * 60, max_entries=256, show_spinner=False)
+def _cached_chat(
+    model_id: str,
+    system_prompt: str,
+    user_prompt: str,
+    max_new_tokens: int,
+    _response: str | None = None,
+) -> str:
     """
-    Call the HF chat model using chat_completion.
+    Response cache keyed on (model_id, system_prompt, user_prompt, max_new_tokens).
 
-    This fixes the previous error:
-    'Model ... is not supported for task text-generation. Supported task: conversational.'
+    Called without _response it acts as a lookup and raises _CacheMiss when
+    nothing is stored (exceptions are not cached by Streamlit). Called with
+    _response it stores that text. The underscore keeps it out of the hash.
     """
-    client = get_hf_client()
-    if client is None:
-        return "⚠️ Модель не настроена. Проверьте HF_TOKEN в secrets."
+    if _response is None:
+        raise _CacheMiss
+    return _response
+
+
+@retry_transient
+def _open_chat_stream(client, **kwargs):
+    """Start a streaming chat_completion. Only opening is retried, never a half-read stream."""
+    return client.chat_completion(stream=True, **kwargs)
+
+
+@retry_transient
+async def _open_chat_stream_async(client, **kwargs):
+    """Async twin of _open_chat_stream."""
+    return await client.chat_completion(stream=True, **kwargs)
+
 
+def call_model_stream(
+    client, system_prompt: str, user_prompt: str, max_new_tokens: int, stop=None
+):
+    """Yield content deltas from a streaming chat_completion."""
     messages = [
         {"role": "system", "content": system_prompt},
         {"role": "user", "content": user_prompt},
     ]
 
-    try:
-        response = client.chat_completion(
+    for chunk in _open_chat_stream(
+        client,
+        messages=messages,
+        max_tokens=max_new_tokens,
+        temperature=TEMPERATURE,
+        top_p=TOP_P,
+        stop=stop,
+    ):
+        # HF streaming returns chunks with choices[0].delta
+        yield chunk.choices[0].delta.content or ""
+
+
+def _stream_chat(
+    client,
+    system_prompt: str,
+    user_prompt: str,
+    max_new_tokens: int,
+    placeholder=None,
+    stop=None,
+) -> str:
+    """Stream a chat_completion, rendering it with write_stream into placeholder if given."""
+    deltas = call_model_stream(client, system_prompt, user_prompt, max_new_tokens, stop)
+    if placeholder is None:
+        return "".join(deltas).strip()
+    return placeholder.write_stream(deltas).strip()
+
+
+async def _stream_chat_async(
+    model_id: str,
+    system_prompt: str,
+    user_prompt: str,
+    max_new_tokens: int,
+    stop=None,
+) -> str:
+    """
+    Async twin of _stream_chat (no rendering), used by the A/B/C fan-out.
+
+    The client is bound to the running event loop (asyncio.run closes it
+    afterwards), so it is created and closed per call.
+    """
+    messages = [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": user_prompt},
+    ]
+
+    buf = ""
+    async with _hf().AsyncInferenceClient(
+        model_id, token=HF_TOKEN, headers=HF_HEADERS, timeout=HF_TIMEOUT_S
+    ) as client:
+        stream = await _open_chat_stream_async(
+            client,
             messages=messages,
             max_tokens=max_new_tokens,
-            temperature=0.7,
-            top_p=0.95,
+            temperature=TEMPERATURE,
+            top_p=TOP_P,
+            stop=stop,
         )
-        # HF chat_completion returns an object with choices
-        return response.choices[0].message["content"].strip()
+        async for chunk in stream:
+            buf += chunk.choices[0].delta.content or ""
+    return buf.strip()
+
+
+def adaptive_max_tokens(input_text: str, ceiling: int, floor: int = 80) -> int:
+    """
+    Clip the output budget to the size of the input.
+
+    Short inputs don't need the full ceiling, and generation time grows with
+    every token, so the budget is floor + 1.5 tokens per input word, capped at
+    ceiling. Callers set floor to what a complete answer needs even for a
+    one-line input; only a lower ceiling (the user's cap) goes below it.
+    """
+    return min(ceiling, floor + int(len(input_text.split()) * 1.5))
+
+
+def call_model(
+    system_prompt: str,
+    user_prompt: str,
+    max_new_tokens: int = 512,
+    placeholder=None,
+    client=None,
+    stop: list[str] | None = None,
+    model_id: str | None = None,
+) -> str:
+    """
+    Call the HF chat model using chat_completion.
+
+    This fixes the previous error:
+    'Model ... is not supported for task text-generation. Supported task: conversational.'
+    Identical prompts are served from cache (see _cached_chat); otherwise tokens
+    are streamed into `placeholder` (an st.empty()) as they arrive.
+    The model comes from the sidebar override, then `model_id`, then
+    pick_model(); `client` defaults to the session's client for that model.
+    Generation ends early at any of the `stop` sequences.
+    """
+    model_id = model_override or model_id or pick_model(user_prompt, max_new_tokens)
+    if client is None:
+        client = get_hf_client(model_id)
+    if client is None:
+        return MODEL_NOT_CONFIGURED
+
+    try:
+        return _cached_chat(model_id, system_prompt, user_prompt, max_new_tokens)
+    except _CacheMiss:
+        pass
+
+    try:
+        text = _stream_chat(client, system_prompt, user_prompt, max_new_tokens, placeholder, stop)
     except Exception as e:
         return f"⚠️ Ошибка при вызове модели: {e}"
+    if not text:
+        # Don't memoize an empty completion; the next click should retry.
+        return text
+    return _cached_chat(model_id, system_prompt, user_prompt, max_new_tokens, _response=text)
+
+
+# Upper bound on simultaneous model calls in one fan-out (HF Inference rate limits).
+MAX_CONCURRENT_CALLS = 4
+
+
+async def _fan_out(jobs: list[tuple[str, str, str, int]]) -> list:
+    """
+    Run (model_id, system_prompt, user_prompt, max_new_tokens) jobs concurrently.
+
+    At most MAX_CONCURRENT_CALLS run at once. Results keep the job order;
+    failures are returned as exceptions instead of cancelling the others.
+    """
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_CALLS)
+
+    async def run(job):
+        async with semaphore:
+            return await _stream_chat_async(*job)
+
+    return await asyncio.gather(*(run(job) for job in jobs), return_exceptions=True)
+
+
+def call_model_parallel(
+    jobs: list[tuple[str, str, int]], model_id: str | None = None
+) -> list[str]:
+    """
+    Run several (system_prompt, user_prompt, max_new_tokens) jobs concurrently.
+
+    Cache hits are answered directly; the misses are fanned out with _fan_out.
+    Results keep the job order, and a failed job doesn't affect the others.
+    The model is chosen as in call_model.
+    """
+    results: list[str] = [""] * len(jobs)
+    misses = {}
+    requested_model = model_id
+    for i, (system_prompt, user_prompt, max_new_tokens) in enumerate(jobs):
+        model_id = (
+            model_override or requested_model or pick_model(user_prompt, max_new_tokens)
+        )
+        if get_hf_client(model_id) is None:
+            results[i] = MODEL_NOT_CONFIGURED
+            continue
+        try:
+            results[i] = _cached_chat(model_id, system_prompt, user_prompt, max_new_tokens)
+        except _CacheMiss:
+            misses[i] = (model_id, system_prompt, user_prompt, max_new_tokens)
+
+    if misses:
+        texts = asyncio.run(_fan_out(list(misses.values())))
+        for (i, job), text in zip(misses.items(), texts):
+            if isinstance(text, Exception):
+                results[i] = f"⚠️ Ошибка при вызове модели: {text}"
+                continue
+            if text:
+                text = _cached_chat(*job, _response=text)
+            results[i] = text
+    return results
+
+
+# <<<NAME>>> opens a section; it runs until the next marker (its own
+# <<<END_NAME>>> or the next section) or the end of a truncated response.
+_SECTION_RE = re.compile(r"<<<(?!END_)(\w+)>>>(.*?)(?=<<<\w+>>>|\Z)", re.S)
+
+
+def parse_sections(raw: str, sections: list[str]) -> dict[str, str]:
+    """Slice a multi-section response into {name: text}; missing sections are ""."""
+    found = {name: text.strip() for name, text in _SECTION_RE.findall(raw)}
+    if not found:
+        # Model ignored the format (or call_model returned an error message).
+        found = {sections[0]: raw.strip()}
+    return {name: found.get(name, "") for name in sections}
+
+
+def call_model_multi(
+    system_prompt: str, user_prompt: str, sections: list[str], **kwargs
+) -> dict[str, str]:
+    """
+    Produce several named outputs with one call_model request.
+
+    The prompt is extended with the expected <<<NAME>>>...<<<END_NAME>>>
+    layout and the response is split with parse_sections. Generation stops at
+    the last END marker instead of running to max_new_tokens. Extra keyword
+    arguments go to call_model.
+    """
+    layout = " ".join(f"<<<{name}>>>...<<<END_{name}>>>" for name in sections)
+    user_prompt = f"{user_prompt}\nOutput EXACTLY in this format: {layout}\n"
+    stop = [f"<<<END_{sections[-1]}>>>"]
+    return parse_sections(call_model(system_prompt, user_prompt, stop=stop, **kwargs), sections)
+
+
+def start_generation():
+    """
+    on_click of the generate buttons.
+
+    Callbacks run before the rerun, so the tab draws its buttons disabled for
+    the whole generating run; end_generation() redraws them enabled.
+    """
+    st.session_state["gen_in_flight"] = True
+
+
+def begin_tab_run() -> bool:
+    """Start of a tab fragment: show deferred notices, return whether this run generates."""
+    for kind, message in st.session_state.pop("notices", []):
+        getattr(st, kind)(message)
+    return st.session_state.pop("gen_in_flight", False)
+
+
+def notify(kind: str, message: str):
+    """st.<kind>(message) that survives end_generation()'s rerun."""
+    st.session_state.setdefault("notices", []).append((kind, message))
+
+
+def end_generation(in_flight: bool):
+    """Rerun the tab fragment after a generating run so its buttons are enabled again."""
+    if not in_flight:
+        return
+    try:
+        st.rerun(scope="fragment")
+    except st.errors.StreamlitAPIException:
+        # Only allowed during a fragment rerun; fall back to a full rerun.
+        st.rerun()
 
 
 # ---------------------------
 # GOOGLE SHEETS HELPERS
 # ---------------------------
 
+GSHEET_SCOPES = [
+    "https://www.googleapis.com/auth/spreadsheets",
+    "https://www.googleapis.com/auth/drive",
+]
+
+
 @st.cache_resource(show_spinner=False)
+def _get_credentials():
+    """Parse service-account info from secrets once; the token refreshes itself."""
+    from google.oauth2.service_account import Credentials
+
+    return Credentials.from_service_account_info(GCP_SERVICE_ACCOUNT, scopes=GSHEET_SCOPES)
+
+
+def _pooled_session(credentials) -> AuthorizedSession:
+    """AuthorizedSession with a small keep-alive pool, also used for token refreshes."""
+    from google.auth.transport.requests import AuthorizedSession, Request
+
+    refresh_session = requests.Session()
+    refresh_session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=4))
+    session = AuthorizedSession(
+        credentials, auth_request=Request(refresh_session)
+    )
+    session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=4))
+    return session
+
+
+# Rebuilt every 50 minutes, before the 1h access token expires.
+@st.cache_resource(show_spinner=False, ttl="50m", max_entries=1, on_release=_release_client)
 def get_gsheet_client():
     """Create gspread client from service-account info in secrets."""
     if not GCP_SERVICE_ACCOUNT:
         return None
 
     try:
-        scopes = [
-            "https://www.googleapis.com/auth/spreadsheets",
-            "https://www.googleapis.com/auth/drive",
-        ]
-        credentials = Credentials.from_service_account_info(
-            GCP_SERVICE_ACCOUNT, scopes=scopes
-        )
-        client = gspread.authorize(credentials)
-        return client
+        credentials = _get_credentials()
+        return _gspread().Client(auth=credentials, session=_pooled_session(credentials))
     except Exception:
         return None
 
 
+@st.cache_resource(show_spinner=False)
+def _get_spreadsheet() -> gspread.Spreadsheet:
+    """Open the spreadsheet once (by key if configured) and reuse the handle across reruns."""
+    client = get_gsheet_client()
+    if SPREADSHEET_KEY:
+        return client.open_by_key(SPREADSHEET_KEY)
+    return client.open(SPREADSHEET_NAME)
+
+
+@st.cache_resource(show_spinner=False)
+def _get_worksheet(sheet_name: str) -> gspread.Worksheet:
+    """Open (or create) a worksheet once and reuse the handle across reruns."""
+    sh = _get_spreadsheet()
+    try:
+        return sh.worksheet(sheet_name)
+    except _gspread().WorksheetNotFound:
+        header = SHEET_HEADERS[sheet_name]
+        ws = sh.add_worksheet(title=sheet_name, rows=1000, cols=len(header))
+        ws.append_row(header, value_input_option="RAW")
+        return ws
+
+
+@st.cache_resource(show_spinner=False, on_release=_release_client)
+def _get_sheets_session() -> AuthorizedSession:
+    """Keep-alive HTTPS session for direct Sheets REST calls, shared by all appends."""
+    return _pooled_session(_get_credentials())
+
+
+@st.cache_data(show_spinner=False)
+def _append_url(sheet_name: str) -> str:
+    """values.append endpoint for sheet_name (the worksheet is created if missing)."""
+    _get_worksheet(sheet_name)
+    sid = _get_spreadsheet().id
+    return (
+        f"https://sheets.googleapis.com/v4/spreadsheets/{sid}"
+        f"/values/{quote(sheet_name)}:append?valueInputOption=RAW"
+    )
+
+
+# values:append is not idempotent: after a read timeout or a 500/502/504 the rows
+# may already be in the sheet, and a resend would duplicate them. Writes are only
+# retried when Sheets certainly didn't apply them.
+WRITE_RETRY_STATUS = {429, 503}
+
+
+def _write_not_applied(exc: BaseException) -> bool:
+    """True if a failed Sheets write is safe to resend: throttled, or never connected."""
+    if isinstance(exc, requests.ConnectTimeout):
+        return True
+    if isinstance(exc, requests.ConnectionError):
+        # A refused/unresolvable connection: requests wraps urllib3's MaxRetryError.
+        reason = getattr(exc.args[0], "reason", None) if exc.args else None
+        return isinstance(reason, NewConnectionError)
+    response = getattr(exc, "response", None)
+    return getattr(response, "status_code", None) in WRITE_RETRY_STATUS
+
+
+@retry(
+    retry=retry_if_exception(_write_not_applied),
+    stop=stop_after_attempt(4),
+    wait=wait_exponential(multiplier=1, min=1, max=16),
+    reraise=True,
+)
+def _post_rows(session: AuthorizedSession, url: str, rows: list[list]):
+    """Append rows with a single values.append request (body serialized with orjson)."""
+    response = session.post(
+        url,
+        data=orjson.dumps({"values": rows}),
+        headers={"Content-Type": "application/json"},
+    )
+    response.raise_for_status()
+
+
+def _stale_target(exc: requests.HTTPError) -> bool:
+    """404, or a 400 about the range: the cached spreadsheet/worksheet/URL is outdated."""
+    status = getattr(exc.response, "status_code", None)
+    if status == 404:
+        return True
+    return status == 400 and "unable to parse range" in exc.response.text.lower()
+
+
+def _append_rows(sheet_name: str, rows: list[list]):
+    """Append rows in one API call, re-resolving the worksheet once if the URL is stale."""
+    try:
+        _post_rows(_get_sheets_session(), _append_url(sheet_name), rows)
+    except requests.HTTPError as e:
+        # The caches are process-wide: only drop them when they're the likely
+        # cause, not on 403s, throttling or server errors.
+        if not _stale_target(e):
+            raise
+        _get_spreadsheet.clear()
+        _get_worksheet.clear()
+        _append_url.clear()
+        _post_rows(_get_sheets_session(), _append_url(sheet_name), rows)
+
+
+def _now_iso() -> str:
+    """UTC timestamp for sheet rows (datetime.utcnow() is deprecated in 3.12)."""
+    return datetime.now(timezone.utc).isoformat(timespec="seconds")
+
+
+# Sheets rejects cells over 50 000 characters; stay below with some margin.
+SHEETS_CELL_MAX = 45_000
+
+
+def _fit_cell(text: str) -> tuple[str, str]:
+    """
+    (cell, b64_cell) for a possibly long text.
+
+    Short text goes in as-is with an empty b64 cell. Longer text is cut to
+    SHEETS_CELL_MAX for reading and stored gzip+base64 next to it: in full if
+    the packed form fits in a cell, otherwise cut further until it does.
+    """
+    if len(text) <= SHEETS_CELL_MAX:
+        return text, ""
+    stored = text
+    while True:
+        packed = base64.b64encode(gzip.compress(stored.encode("utf-8"))).decode("ascii")
+        if len(packed) <= SHEETS_CELL_MAX:
+            return text[:SHEETS_CELL_MAX] + " …", packed
+        # Packed size is roughly proportional to the text length; aim a bit low.
+        stored = stored[: int(len(stored) * SHEETS_CELL_MAX / len(packed) * 0.95)]
+
+
+# Rows are buffered per session and written with a single append_rows call.
+SHEET_BUFFERS = {
+    JOBPOSTS_SHEET: "jobpost_buffer",
+    RESEARCH_SHEET: "research_buffer",
+}
+# Flush when this many rows are pending, or when the last flush is older than
+# FLUSH_INTERVAL_S (so bursts of saves are batched, single saves are not held back).
+# The sidebar queue fragment also flushes every FLUSH_INTERVAL_S, so a queued
+# row never waits for the next save.
+FLUSH_THRESHOLD = 10
+FLUSH_INTERVAL_S = 5.0
+# After a failed flush, automatic flushes pause this long (a 403 or a missing
+# sheet won't fix itself in 5 s). The manual flush button always tries.
+FLUSH_BACKOFF_S = 5 * 60
+
+
+def pending_rows(sheet_name: str) -> list[list]:
+    """Rows queued for sheet_name in this session."""
+    return st.session_state.setdefault(SHEET_BUFFERS[sheet_name], [])
+
+
+def flush_paused() -> bool:
+    """True while automatic flushes are backing off after an error."""
+    return time.monotonic() < st.session_state.get("sheets_flush_paused_until", 0.0)
+
+
+def dead_letter_rows() -> list[tuple[str, list, str]]:
+    """(sheet_name, row, error) for rows Sheets rejected; kept out of the queue."""
+    return st.session_state.setdefault("sheets_dead_letter", [])
+
+
+# 400 INVALID_ARGUMENT / 413: Sheets refuses the data itself (e.g. an oversized
+# cell). 401/403/404 are setup problems, so those rows stay queued.
+REJECTED_DATA_STATUS = {400, 413}
+
+
+def _rejects_data(exc: requests.HTTPError) -> bool:
+    """True if Sheets rejected the rows themselves, so resending them can't succeed."""
+    return getattr(exc.response, "status_code", None) in REJECTED_DATA_STATUS
+
+
+def flush_sheet_buffer(sheet_name: str) -> int:
+    """Write all queued rows for sheet_name. Returns how many rows were written."""
+    rows = pending_rows(sheet_name)
+    if not rows:
+        return 0
+    try:
+        _append_rows(sheet_name, rows)
+        count = len(rows)
+        # Only drop the rows once the write succeeded.
+        rows.clear()
+    except requests.HTTPError as e:
+        if not _rejects_data(e):
+            raise
+        count = _flush_rows_singly(sheet_name, rows)
+    st.session_state["sheets_last_flush"] = time.monotonic()
+    return count
+
+
+def _flush_rows_singly(sheet_name: str, rows: list[list]) -> int:
+    """
+    Write rows one at a time after Sheets rejected the batch.
+
+    Rejected rows go to dead_letter_rows() so they don't fail every later
+    flush; transient errors stop the loop and leave the rest queued.
+    """
+    session, url = _get_sheets_session(), _append_url(sheet_name)
+    count = 0
+    while rows:
+        try:
+            _post_rows(session, url, [rows[0]])
+            count += 1
+        except requests.HTTPError as e:
+            if not _rejects_data(e):
+                raise
+            dead_letter_rows().append((sheet_name, rows[0], str(e)))
+            st.warning(f"Строка отклонена Google Sheets ({sheet_name}) и убрана из очереди: {e}")
+        rows.pop(0)
+    return count
+
+
+def queue_row(sheet_name: str, row: list, force: bool = False) -> int:
+    """
+    Queue a row and flush if forced, the batch is full or the last flush is stale.
+
+    Returns how many rows were written (0 if the row is only queued).
+    """
+    rows = pending_rows(sheet_name)
+    rows.append(row)
+    since_flush = time.monotonic() - st.session_state.get("sheets_last_flush", 0.0)
+    if force or (
+        (len(rows) >= FLUSH_THRESHOLD or since_flush > FLUSH_INTERVAL_S) and not flush_paused()
+    ):
+        return flush_sheet_buffer(sheet_name)
+    return 0
+
+
+def _gen_and_save(generate):
+    """
+    Call generate() (a model call on the script thread) while the queued Sheets
+    rows are written from a worker thread, so the writes cost no extra wait.
+
+    Returns generate()'s result. Rows are dropped from the queue only once
+    their write succeeded; if Sheets can't be reached they stay queued.
+    """
+    pending = {name: list(pending_rows(name)) for name in SHEET_BUFFERS}
+    pending = {name: rows for name, rows in pending.items() if rows}
+    if gc_client is None or not pending or flush_paused():
+        return generate()
+
+    # Session and URLs are resolved here: Streamlit caches need the script thread.
+    try:
+        session = _get_sheets_session()
+        urls = {name: _append_url(name) for name in pending}
+    except Exception as e:
+        notify("error", f"Ошибка при записи в Google Sheets: {e}")
+        return generate()
+
+    with ThreadPoolExecutor(max_workers=len(pending)) as pool:
+        writes = {
+            name: pool.submit(_post_rows, session, urls[name], rows)
+            for name, rows in pending.items()
+        }
+        try:
+            return generate()
+        finally:
+            for name, future in writes.items():
+                error = future.exception()
+                if error is not None:
+                    notify("error", f"Ошибка при записи в Google Sheets: {error}")
+                else:
+                    del pending_rows(name)[: len(pending[name])]
+                    st.session_state["sheets_last_flush"] = time.monotonic()
+
+
 def append_jobpost_to_sheet(
-    timestamp: datetime,
+    timestamp: str,
     job_title: str,
     city: str,
     platform: str,
@@ -103,71 +853,499 @@ def append_jobpost_to_sheet(
     target_audience: str,
     application_link: str,
     generated_post: str,
+    sync: bool = False,
 ):
-    gc = get_gsheet_client()
-    if gc is None:
+    if gc_client is None:
         st.warning(
             "Google Sheets не настроен. Проверьте gcp_service_account в secrets и доступ к таблице."
         )
         return
 
     try:
-        sh = gc.open(SPREADSHEET_NAME)
-        try:
-            ws = sh.worksheet(JOBPOSTS_SHEET)
-        except gspread.WorksheetNotFound:
-            ws = sh.add_worksheet(title=JOBPOSTS_SHEET, rows=1000, cols=10)
-
-        ws.append_row(
+        written = queue_row(
+            JOBPOSTS_SHEET,
             [
-                timestamp.isoformat(),
+                timestamp,
                 job_title,
                 city,
                 platform,
                 variant_label,
                 target_audience,
                 application_link,
-                generated_post,
-            ]
+                *_fit_cell(generated_post),
+            ],
+            force=sync,
         )
-        st.success("✅ Объявление сохранено в Google Sheets (JobPosts).")
+        if written:
+            st.success(f"✅ Сохранено в Google Sheets (JobPosts): {written} шт.")
+        else:
+            st.info("🕒 Объявление добавлено в очередь и будет отправлено в Sheets через несколько секунд.")
     except Exception as e:
         st.error(f"Ошибка при записи в Google Sheets: {e}")
 
 
 def append_research_to_sheet(
-    timestamp: datetime,
+    timestamp: str,
     question_type: str,
     input_text: str,
     insights: str,
+    sync: bool = False,
 ):
-    gc = get_gsheet_client()
-    if gc is None:
+    if gc_client is None:
         st.warning(
             "Google Sheets не настроен. Проверьте gcp_service_account в secrets и доступ к таблице."
         )
         return
 
+    # Pasted tables have no length limit, so the input can outgrow a cell too.
+    input_cell, input_b64 = _fit_cell(input_text)
     try:
-        sh = gc.open(SPREADSHEET_NAME)
-        try:
-            ws = sh.worksheet(RESEARCH_SHEET)
-        except gspread.WorksheetNotFound:
-            ws = sh.add_worksheet(title=RESEARCH_SHEET, rows=1000, cols=10)
-
-        ws.append_row(
+        written = queue_row(
+            RESEARCH_SHEET,
             [
-                timestamp.isoformat(),
+                timestamp,
                 question_type,
-                input_text,
-                insights,
-            ]
+                input_cell,
+                *_fit_cell(insights),
+                input_b64,
+            ],
+            force=sync,
         )
-        st.success("✅ Инсайты сохранены в Google Sheets (ResearchInsights).")
+        if written:
+            st.success(f"✅ Сохранено в Google Sheets (ResearchInsights): {written} шт.")
+        else:
+            st.info("🕒 Инсайты добавлены в очередь и будут отправлены в Sheets через несколько секунд.")
     except Exception as e:
         st.error(f"Ошибка при записи в Google Sheets: {e}")
 
 
+# ---------------------------
+# BATCH API (RESEARCH, NON-INTERACTIVE)
+# ---------------------------
+# create (upload JSONL + /batches) → monitor (poll /batches/{id}) → retrieve
+# (output file) → append to ResearchInsights.
+BATCH_ENDPOINT = "/v1/chat/completions"
+BATCH_COMPLETION_WINDOW = "24h"
+BATCH_POLL_S = 60
+BATCH_FAILED = {"failed", "expired", "cancelled", "cancelling"}
+
+
+@st.cache_resource(show_spinner=False, on_release=_release_client)
+def _get_batch_session() -> requests.Session:
+    """Keep-alive session for the Batch API with the bearer token preset."""
+    session = requests.Session()
+    session.headers["Authorization"] = f"Bearer {BATCH_API_KEY}"
+    session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=2))
+    return session
+
+
+def _batch_url(path: str) -> str:
+    return f"{BATCH_API_BASE.rstrip('/')}{path}"
+
+
+def submit_research_batch(system_prompt: str, user_prompt: str, max_new_tokens: int) -> str:
+    """Upload one chat request as a batch input file and start the batch. Returns the batch id."""
+    session = _get_batch_session()
+    line = {
+        "custom_id": uuid.uuid4().hex,
+        "method": "POST",
+        "url": BATCH_ENDPOINT,
+        "body": {
+            "model": BATCH_MODEL_ID,
+            "messages": [
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": user_prompt},
+            ],
+            "max_tokens": max_new_tokens,
+            "temperature": TEMPERATURE,
+            "top_p": TOP_P,
+        },
+    }
+    resp = session.post(
+        _batch_url("/files"),
+        data={"purpose": "batch"},
+        files={"file": ("research.jsonl", orjson.dumps(line) + b"\n", "application/jsonl")},
+        timeout=60,
+    )
+    resp.raise_for_status()
+    resp = session.post(
+        _batch_url("/batches"),
+        data=orjson.dumps(
+            {
+                "input_file_id": resp.json()["id"],
+                "endpoint": BATCH_ENDPOINT,
+                "completion_window": BATCH_COMPLETION_WINDOW,
+            }
+        ),
+        headers={"Content-Type": "application/json"},
+        timeout=30,
+    )
+    resp.raise_for_status()
+    return resp.json()["id"]
+
+
+@retry_transient
+def fetch_batch_result(batch_id: str) -> str | None:
+    """Completion text of a finished batch, or None while it is still running."""
+    session = _get_batch_session()
+    resp = session.get(_batch_url(f"/batches/{batch_id}"), timeout=30)
+    resp.raise_for_status()
+    batch = resp.json()
+    status = batch.get("status")
+    if status in BATCH_FAILED:
+        raise RuntimeError(f"batch {batch_id}: {status}")
+    if status != "completed":
+        return None
+
+    # A batch whose only request failed is still "completed", but with no
+    # output file; the failure is in the error file instead.
+    if not batch.get("output_file_id"):
+        error_file_id = batch.get("error_file_id")
+        if not error_file_id:
+            raise RuntimeError(f"batch {batch_id}: no output ({batch.get('errors')})")
+        failed = _batch_file_line(session, error_file_id)
+        raise RuntimeError(f"batch {batch_id}: {failed.get('error') or failed.get('response')}")
+
+    result = _batch_file_line(session, batch["output_file_id"])
+    if result.get("error"):
+        raise RuntimeError(f"batch {batch_id}: {result['error']}")
+    return result["response"]["body"]["choices"][0]["message"]["content"].strip()
+
+
+def _batch_file_line(session: requests.Session, file_id: str) -> dict:
+    """First JSONL line of a batch output/error file (one request per batch, so the only one)."""
+    resp = session.get(_batch_url(f"/files/{file_id}/content"), timeout=60)
+    resp.raise_for_status()
+    return orjson.loads(resp.content.splitlines()[0])
+
+
+def pending_batches() -> list[dict]:
+    """Research batches submitted in this session and not yet written to the sheet."""
+    return st.session_state.setdefault("research_batches", [])
+
+
+# ---------------------------
+# JOB POST + SUMMARY GENERATION
+# ---------------------------
+
+class SafeDict(dict):
+    """format_map mapping that leaves unknown {fields} in place instead of raising."""
+
+    def __missing__(self, key):
+        return "{" + key + "}"
+
+
+@st.cache_data(show_spinner=False)
+def load_example() -> str:
+    """Style example for the job post prompt, read from static/ once per process."""
+    path = Path(__file__).parent / "static" / "jobpost_example.txt"
+    return path.read_text(encoding="utf-8").strip()
+
+
+# Prompt texts are written flush-left (no runtime dedent); only the {fields} are filled in per click.
+JOBPOST_INSTRUCTIONS: Final[str] = (
+    """
+ЧАСТЬ 1. Составь русскоязычное объявление о вакансии в стиле ниже (с эмодзи и структурой).
+
+ПРИМЕР СТИЛЯ:
+"""
+    + load_example()
+    + """
+
+Требования:
+- Сохрани похожую структуру и эмодзи-блоки, как в примере.
+- Обязательно укажи город/регион.
+- Если есть информация о зарплате, графике, жилье, транспорте — выдели её.
+- Текст должен быть понятен русскоязычным рабочим.
+
+Пиши текст на русском языке.
+"""
+)
+
+SUMMARY_INSTRUCTIONS: Final[str] = """
+PART 2. Summarize the same job in 5–7 bullet points for an internal report.
+Focus on:
+- job title
+- location
+- key requirements
+- salary/benefits (if mentioned)
+- ideal candidate profile
+"""
+
+JOB_DATA_TEMPLATE: Final[str] = """
+ДАННЫЕ НОВОЙ ВАКАНСИИ:
+
+Должность: {job_title}
+Город / Регион: {city}
+Целевая аудитория: {target_audience}
+Вариант: {variant_label}
+Платформа: {platform}
+Предпочтительный тон: {tone}
+
+Сырой текст / заметки:
+{raw_description}
+
+{cta}
+"""
+
+# Everything static, including the style example, lives in the system prompt:
+# it is byte-identical for every vacancy, variant and city, so the backend can
+# reuse its prefill. The user prompt carries only the job data.
+SYSTEM_PROMPT_POST_AND_SUMMARY: Final[str] = (
+    SYSTEM_PROMPT_JOBPOST
+    + "\n\n"
+    + SYSTEM_PROMPT_SUMMARY
+    + "\n"
+    + JOBPOST_INSTRUCTIONS
+    + SUMMARY_INSTRUCTIONS
+    + "\nSection POST is the job post from part 1, section SUMMARY is the summary from part 2.\n"
+)
+
+# Post-only generation (A/B/C variants): same static prefix idea, no summary part.
+SYSTEM_PROMPT_JOBPOST_FULL: Final[str] = SYSTEM_PROMPT_JOBPOST + "\n" + JOBPOST_INSTRUCTIONS
+
+# Stand-alone summary (small model), used when only the summary is requested.
+SUMMARY_USER_TEMPLATE: Final[str] = """
+Summarize this job in 5–7 bullet points for an internal report.
+Focus on:
+- job title
+- location
+- key requirements
+- salary/benefits (if mentioned)
+- ideal candidate profile
+
+Job title: {job_title}
+City / Region: {city}
+
+Raw details:
+{raw_description}
+"""
+
+RESEARCH_USER_TEMPLATE: Final[str] = """
+Пожалуйста:
+1) Кратко опиши, что происходит.
+2) Выдели самые важные риски или возможности.
+3) Дай 3–5 конкретных, практических рекомендаций, что делать дальше.
+
+Вот мой вопрос / данные:
+
+{research_input}
+"""
+
+
+def build_job_data_prompt(
+    job_title: str,
+    city: str,
+    platform: str,
+    tone: str,
+    target_audience: str,
+    variant_label: str,
+    application_link: str,
+    raw_description: str,
+) -> str:
+    """Fill JOB_DATA_TEMPLATE (the per-job part of the user prompt), including the CTA."""
+    if application_link.strip():
+        cta = (
+            f"В конце добавь блок с призывом:\n"
+            f"👉 Заинтересованы? Заполните форму по ссылке: {application_link}\n"
+        )
+    else:
+        cta = (
+            "В конце добавь блок с призывом:\n"
+            "👉 Заинтересованы? Напишите нам в WhatsApp или заполните анкету.\n"
+        )
+
+    return JOB_DATA_TEMPLATE.format_map(
+        SafeDict(
+            job_title=job_title,
+            city=city,
+            target_audience=target_audience,
+            variant_label=variant_label,
+            platform=platform,
+            tone=tone,
+            raw_description=raw_description,
+            cta=cta,
+        )
+    )
+
+
+def generate_post_and_summary(
+    job_title: str,
+    city: str,
+    platform: str,
+    tone: str,
+    target_audience: str,
+    variant_label: str,
+    application_link: str,
+    raw_description: str,
+    placeholder=None,
+    max_new_tokens: int = 600,
+) -> tuple[str, str]:
+    """
+    Generate the Russian job post and the employer summary in one model call.
+
+    Both outputs share the same raw_description, so a single request avoids a
+    second prefill of the same context. Returns (post, summary).
+    """
+    user_prompt = build_job_data_prompt(
+        job_title=job_title,
+        city=city,
+        platform=platform,
+        tone=tone,
+        target_audience=target_audience,
+        variant_label=variant_label,
+        application_link=application_link,
+        raw_description=raw_description,
+    )
+
+    sections = call_model_multi(
+        SYSTEM_PROMPT_POST_AND_SUMMARY,
+        user_prompt,
+        ["POST", "SUMMARY"],
+        max_new_tokens=max_new_tokens,
+        placeholder=placeholder,
+        # Creative writing stays on the 7B model; the short user prompt would
+        # otherwise route it to the fast one.
+        model_id=MODEL_ID_DEEP,
+    )
+    return sections["POST"], sections["SUMMARY"]
+
+
+def generate_variants(
+    job_title: str,
+    city: str,
+    platform: str,
+    tone: str,
+    target_audience: str,
+    application_link: str,
+    raw_description: str,
+    max_new_tokens: int = 300,
+) -> dict[str, str]:
+    """Generate job posts for every variant label concurrently. Returns {label: post}."""
+    jobs = [
+        (
+            SYSTEM_PROMPT_JOBPOST_FULL,
+            build_job_data_prompt(
+                job_title=job_title,
+                city=city,
+                platform=platform,
+                tone=tone,
+                target_audience=target_audience,
+                variant_label=label,
+                application_link=application_link,
+                raw_description=raw_description,
+            ),
+            max_new_tokens,
+        )
+        for label in VARIANT_LABELS
+    ]
+    return dict(zip(VARIANT_LABELS, call_model_parallel(jobs, model_id=MODEL_ID_DEEP)))
+
+
+def generate_summary(
+    job_title: str,
+    city: str,
+    raw_description: str,
+    placeholder=None,
+    max_new_tokens: int = 250,
+) -> str:
+    """Generate only the employer summary, on SUMMARY_MODEL_ID."""
+    user_prompt = SUMMARY_USER_TEMPLATE.format_map(
+        SafeDict(job_title=job_title, city=city, raw_description=raw_description)
+    )
+    return call_model(
+        SYSTEM_PROMPT_SUMMARY,
+        user_prompt,
+        max_new_tokens=max_new_tokens,
+        placeholder=placeholder,
+        model_id=SUMMARY_MODEL_ID,
+    )
+
+
+VARIANT_LABELS = ["A", "B", "C"]
+
+
+# Output budget for the post + summary call by (tone, platform). Short messenger
+# posts need far fewer tokens than the worst case; the summary adds a fixed part.
+TOKEN_BUDGET = {
+    ("Простой и понятный", "Telegram"): 220,
+    ("Простой и понятный", "WhatsApp"): 220,
+    ("Срочно, но без паники", "Telegram"): 220,
+    ("Срочно, но без паники", "WhatsApp"): 220,
+    ("Профессиональный", "Facebook"): 340,
+    ("Профессиональный", "Generic"): 340,
+}
+DEFAULT_TOKEN_BUDGET = 300
+SUMMARY_TOKEN_BUDGET = 200
+# A post expands short notes into a full structured text (Cyrillic + emoji are
+# token-heavy), so its length doesn't follow the input: budget at least this.
+# Keep it at or below the smallest TOKEN_BUDGET entry, or that entry never applies.
+POST_TOKEN_FLOOR = 200
+# Research answers follow a fixed outline (analysis + 3–5 recommendations), so a
+# one-line question needs about as much room as a pasted table.
+RESEARCH_TOKEN_FLOOR = 400
+
+
+def post_token_budget(tone: str, platform: str) -> int:
+    """Token ceiling for the post + summary call for this tone/platform."""
+    return TOKEN_BUDGET.get((tone, platform), DEFAULT_TOKEN_BUDGET) + SUMMARY_TOKEN_BUDGET
+
+
+# A field needs at least one run of 3+ non-space characters to be worth a model call.
+_MIN_INPUT = re.compile(r"\S{3,}")
+
+
+def has_min_input(text: str | None) -> bool:
+    """Reject empty, whitespace-only or near-empty inputs before calling the model."""
+    return _MIN_INPUT.search(text or "") is not None
+
+
+def inputs_key(*values) -> bytes:
+    """Short, fast fingerprint of form inputs (non-cryptographic use)."""
+    return hashlib.blake2b(pickle.dumps(values), digest_size=16).digest()
+
+
+# ---------------------------
+# CLIENTS (resolved once per session)
+# ---------------------------
+
+def _session_client(key: str, factory):
+    """Resolve a cached client once and keep it in st.session_state for reuse across reruns."""
+    if key not in st.session_state:
+        st.session_state[key] = factory()
+    return st.session_state[key]
+
+
+gc_client = _session_client("gc_client", get_gsheet_client)
+
+# Build the HF clients on the first run of a session, so the first click
+# doesn't also pay for the huggingface_hub import and client setup.
+for _model_id in HF_MODELS:
+    get_hf_client(_model_id)
+
+
+# ---------------------------
+# GENERATION HISTORY
+# ---------------------------
+
+HISTORY_MAX_ITEMS = 20
+
+
+class _LRU(OrderedDict):
+    """OrderedDict that keeps only the HISTORY_MAX_ITEMS most recently set entries."""
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.move_to_end(key)
+        if len(self) > HISTORY_MAX_ITEMS:
+            self.popitem(last=False)
+
+
+def gen_history() -> _LRU:
+    """Bounded per-session history of generated texts (session_state is never auto-cleaned)."""
+    return st.session_state.setdefault("gen_history", _LRU())
+
+
 # ---------------------------
 # UI CONFIG
 # ---------------------------
@@ -186,7 +1364,12 @@ st.caption(
 # Sidebar status
 st.sidebar.header("Статус системы")
 
-st.sidebar.write(f"Модель: `{MODEL_ID}`")
+model_choice = st.sidebar.selectbox(
+    "Модель",
+    ["Авто", *HF_MODELS],
+    help=f"Авто: короткие запросы → `{MODEL_ID_FAST}`, длинные → `{MODEL_ID_DEEP}`.",
+)
+model_override = None if model_choice == "Авто" else model_choice
 
 if HF_TOKEN:
     st.sidebar.success("HF_TOKEN настроен ✅")
@@ -198,6 +1381,15 @@ if GCP_SERVICE_ACCOUNT:
 else:
     st.sidebar.warning("gcp_service_account не настроен — запись в Sheets отключена.")
 
+max_tokens_cap = st.sidebar.slider(
+    "Лимит токенов ответа",
+    min_value=100,
+    max_value=1000,
+    value=600,
+    step=50,
+    help="Верхняя граница. Фактический лимит подбирается по длине входного текста.",
+)
+
 st.sidebar.markdown("---")
 st.sidebar.markdown(
     "1. Вкладка **Вакансии** — генерируем объявления и резюме.\n"
@@ -213,7 +1405,9 @@ tab_posts, tab_research = st.tabs(
 # ---------------------------
 # TAB 1: POSTS & SUMMARIES
 # ---------------------------
-with tab_posts:
+@st.fragment
+def _render_posts():
+    """Job post tab. As a fragment it reruns alone when its own widgets change."""
     st.subheader("📝 Генерация вакансий и кратких резюме (по-русски)")
 
     st.info(
@@ -222,120 +1416,187 @@ with tab_posts:
         "3. При необходимости сохраните результат в Google Sheets."
     )
 
-    col1, col2 = st.columns(2)
+    in_flight = begin_tab_run()
 
-    with col1:
-        job_title = st.text_input("Должность / Job Title", placeholder="Установщик кухонь")
-        city = st.text_input("Город / Регион", placeholder="Гамбург")
-        platform = st.selectbox(
-            "Платформа",
-            ["Facebook", "Instagram", "Telegram", "WhatsApp", "Generic"],
-            index=0,
-        )
-        tone = st.selectbox(
-            "Тон объявления",
-            ["Простой и понятный", "Дружелюбный", "Профессиональный", "Срочно, но без паники"],
-            index=0,
-        )
+    # Inputs live in a form: typing doesn't rerun the script, only submitting does.
+    with st.form("jobpost_form", clear_on_submit=False):
+        col1, col2 = st.columns(2)
 
-    with col2:
-        target_audience = st.text_input(
-            "Целевая аудитория",
-            placeholder="Иммигранты, ищущие работу в Германии в сфере монтажа кухонь",
-        )
-        variant_label = st.selectbox("Вариант (A/B/C)", ["A", "B", "C"], index=0)
-        application_link = st.text_input(
-            "Ссылка на форму / анкету (опционально)",
-            placeholder="https://docs.google.com/forms/...",
+        with col1:
+            job_title = st.text_input("Должность / Job Title", placeholder="Установщик кухонь")
+            city = st.text_input("Город / Регион", placeholder="Гамбург")
+            platform = st.selectbox(
+                "Платформа",
+                ["Facebook", "Instagram", "Telegram", "WhatsApp", "Generic"],
+                index=0,
+            )
+            tone = st.selectbox(
+                "Тон объявления",
+                ["Простой и понятный", "Дружелюбный", "Профессиональный", "Срочно, но без паники"],
+                index=0,
+            )
+
+        with col2:
+            target_audience = st.text_input(
+                "Целевая аудитория",
+                placeholder="Иммигранты, ищущие работу в Германии в сфере монтажа кухонь",
+            )
+            variant_label = st.selectbox("Вариант (A/B/C)", ["A", "B", "C"], index=0)
+            application_link = st.text_input(
+                "Ссылка на форму / анкету (опционально)",
+                placeholder="https://docs.google.com/forms/...",
+            )
+
+        st.markdown("#### Сырой текст / заметки по вакансии")
+        raw_description = st.text_area(
+            "Опишите детали: зарплата, график, обязанности, требования, документы, жилье и т.д.",
+            height=220,
+            placeholder="Сюда можно вставить пример вроде твоего 2025.0021 – Установщик кухонь...",
         )
 
-    st.markdown("#### Сырой текст / заметки по вакансии")
-    raw_description = st.text_area(
-        "Опишите детали: зарплата, график, обязанности, требования, документы, жилье и т.д.",
-        height=220,
-        placeholder="Сюда можно вставить пример вроде твоего 2025.0021 – Установщик кухонь...",
-    )
+        gen_col1, gen_col2, gen_col3, gen_col4 = st.columns(4)
 
-    gen_col1, gen_col2 = st.columns(2)
+        # Post and "all" share one batched model call (post + summary); the summary
+        # button reuses that result for the same inputs, otherwise it calls the small model.
+        # They render disabled while a model call from this tab is running.
+        button_args = {"disabled": in_flight, "on_click": start_generation}
+        gen_post = gen_col1.form_submit_button(
+            "✏️ Сгенерировать объявление на русском", **button_args
+        )
+        gen_summary = gen_col2.form_submit_button(
+            "📄 Сгенерировать краткое резюме для работодателя (ENG/RU)", **button_args
+        )
+        gen_all = gen_col3.form_submit_button("🚀 Сгенерировать всё", **button_args)
+        gen_variants = gen_col4.form_submit_button("🔀 Сгенерировать A+B+C", **button_args)
 
     generated_post = st.session_state.get("generated_post", "")
     summary_text = st.session_state.get("summary_text", "")
+    variants = st.session_state.get("variants", {})
 
-    # --- Generate Russian job post ---
-    if gen_col1.button("✏️ Сгенерировать объявление на русском"):
-        if not job_title or not city or not raw_description:
-            st.error("Пожалуйста, заполните хотя бы Должность, Город и Сырой текст.")
+    # --- A/B/C variants, generated in parallel ---
+    if gen_variants:
+        if not all(has_min_input(x) for x in (job_title, city, raw_description)):
+            notify("error", "Пожалуйста, заполните хотя бы Должность, Город и Сырой текст.")
         else:
-            with st.spinner("Генерирую объявление..."):
-                system_prompt = (
-                    "Ты — помощник по созданию вакансий для рабочих (blue-collar) в Германии. "
-                    "Ты пишешь объявления в дружелюбном, понятном стиле на РУССКОМ языке. "
-                    "Используй эмодзи для структурирования текста, как в объявлениях в Telegram/WhatsApp.\n\n"
-                    "Правила:\n"
-                    "- Пиши коротко и по делу, без лишней рекламы.\n"
-                    "- Делай чёткие блоки: должность, оплата, график, требования, документы, обязанности, начало работы.\n"
-                    "- В конце всегда добавляй понятный призыв к действию (заполнить форму / написать в WhatsApp).\n"
-                    "- Сохраняй профессиональный, но простой стиль для русскоязычных работников."
+            with st.spinner("Генерирую варианты A, B и C..."):
+                variants = generate_variants(
+                    job_title=job_title,
+                    city=city,
+                    platform=platform,
+                    tone=tone,
+                    target_audience=target_audience,
+                    application_link=application_link,
+                    raw_description=raw_description,
+                    max_new_tokens=adaptive_max_tokens(
+                        raw_description,
+                        min(
+                            max_tokens_cap,
+                            TOKEN_BUDGET.get((tone, platform), DEFAULT_TOKEN_BUDGET),
+                        ),
+                        floor=POST_TOKEN_FLOOR,
+                    ),
                 )
+            st.session_state["variants"] = variants
+
+    if variants:
+        st.markdown("#### 🔀 Варианты объявления")
+        for col, (label, text) in zip(st.columns(len(variants)), variants.items()):
+            with col:
+                st.markdown(f"**Вариант {label}**")
+                st.write(text)
+                if st.button("💾 Сохранить", key=f"save_variant_{label}"):
+                    append_jobpost_to_sheet(
+                        timestamp=_now_iso(),
+                        job_title=job_title,
+                        city=city,
+                        platform=platform,
+                        variant_label=label,
+                        target_audience=target_audience,
+                        application_link=application_link,
+                        generated_post=text,
+                    )
 
-                if application_link.strip():
-                    cta = (
-                        f"В конце добавь блок с призывом:\n"
-                        f"👉 Заинтересованы? Заполните форму по ссылке: {application_link}\n"
+    if gen_post or gen_summary or gen_all:
+        if not all(has_min_input(x) for x in (job_title, city, raw_description)):
+            notify("error", "Пожалуйста, заполните хотя бы Должность, Город и Сырой текст.")
+        else:
+            gen_key = inputs_key(
+                job_title,
+                city,
+                platform,
+                tone,
+                target_audience,
+                variant_label,
+                application_link,
+                raw_description,
+                max_tokens_cap,
+                # A model pinned in the sidebar must not get the previous model's result.
+                model_override,
+            )
+            if (
+                st.session_state.get("last_gen_key") == gen_key
+                and "last_gen_result" in st.session_state
+            ):
+                # Same inputs as the last successful run: reuse it, no model call.
+                post, summary = st.session_state["last_gen_result"]
+            elif gen_summary:
+                # Summary only: a short, constrained task for the small model.
+                with st.spinner("Генерирую краткое резюме..."):
+                    stream_box = st.empty()
+                    post = ""
+                    summary = generate_summary(
+                        job_title, city, raw_description, placeholder=stream_box
                     )
-                else:
-                    cta = (
-                        "В конце добавь блок с призывом:\n"
-                        "👉 Заинтересованы? Напишите нам в WhatsApp или заполните анкету.\n"
+                    stream_box.empty()
+            else:
+                with st.spinner("Генерирую объявление и краткое резюме..."):
+                    stream_box = st.empty()
+                    # Write queued Sheets rows while the model is generating.
+                    post, summary = _gen_and_save(
+                        functools.partial(
+                            generate_post_and_summary,
+                            job_title=job_title,
+                            city=city,
+                            platform=platform,
+                            tone=tone,
+                            target_audience=target_audience,
+                            variant_label=variant_label,
+                            application_link=application_link,
+                            raw_description=raw_description,
+                            placeholder=stream_box,
+                            # Two sections: a full post plus the summary.
+                            max_new_tokens=adaptive_max_tokens(
+                                raw_description,
+                                min(max_tokens_cap, post_token_budget(tone, platform)),
+                                floor=POST_TOKEN_FLOOR + SUMMARY_TOKEN_BUDGET,
+                            ),
+                        )
                     )
+                    stream_box.empty()
 
-                user_prompt = textwrap.dedent(
-                    f"""
-                    Составь русскоязычное объявление о вакансии в стиле ниже (с эмодзи и структурой).
-
-                    ПРИМЕР СТИЛЯ:
-                    "2025.0021 – Установщик кухонь
-                    👤 Должность: Установщик кухонь – 3 вакансии
-                    💶 Оплата (чистыми): 15,50 € / час
-                    📅 График / период работы: Пн–Пт, с 08:00. 180–220 часов в месяц.
-                    🦺 Рабочая одежда: Предоставляется.
-                    🔧 Инструменты: Предоставляются бесплатно.
-                    🚙 Транспорт до работы: Бесплатно (служебный автомобиль).
-                    ..."
-
-                    ТЕПЕРЬ СДЕЛАЙ НОВУЮ ВАКАНСИЮ ПО ЭТИМ ДАННЫМ:
-
-                    Должность: {job_title}
-                    Город / Регион: {city}
-                    Целевая аудитория: {target_audience}
-                    Вариант: {variant_label}
-                    Платформа: {platform}
-                    Предпочтительный тон: {tone}
-
-                    Сырой текст / заметки:
-                    {raw_description}
-
-                    Требования:
-                    - Сохрани похожую структуру и эмодзи-блоки, как в примере.
-                    - Обязательно укажи город/регион.
-                    - Если есть информация о зарплате, графике, жилье, транспорте — выдели её.
-                    - Текст должен быть понятен русскоязычным рабочим.
-
-                    Пиши текст на русском языке.
-                    {cta}
-                    """
-                )
+                # An empty summary means the call failed or ignored the format.
+                if summary:
+                    st.session_state["last_gen_key"] = gen_key
+                    st.session_state["last_gen_result"] = (post, summary)
+                    gen_history()[("post", gen_key)] = (post, summary)
 
-                generated_post = call_model(system_prompt, user_prompt, max_new_tokens=350)
+            if gen_post or gen_all:
+                generated_post = post
                 st.session_state["generated_post"] = generated_post
+            if gen_summary or gen_all:
+                summary_text = summary
+                st.session_state["summary_text"] = summary_text
 
     if generated_post:
         st.markdown("#### ✏️ Сгенерированное объявление (русский)")
         st.write(generated_post)
 
-        if st.button("💾 Сохранить объявление в Google Sheets"):
+        save_col1, save_col2 = st.columns(2)
+        save = save_col1.button("💾 Сохранить объявление в Google Sheets")
+        save_and_sync = save_col2.button("🔄 Сохранить и синхронизировать")
+        if save or save_and_sync:
             append_jobpost_to_sheet(
-                timestamp=datetime.utcnow(),
+                timestamp=_now_iso(),
                 job_title=job_title,
                 city=city,
                 platform=platform,
@@ -343,50 +1604,26 @@ with tab_posts:
                 target_audience=target_audience,
                 application_link=application_link,
                 generated_post=generated_post,
+                sync=save_and_sync,
             )
 
-    # --- Generate employer-facing summary ---
-    if gen_col2.button("📄 Сгенерировать краткое резюме для работодателя (ENG/RU)"):
-        if not job_title or not city or not raw_description:
-            st.error("Пожалуйста, заполните хотя бы Должность, Город и Сырой текст.")
-        else:
-            with st.spinner("Генерирую краткое резюме..."):
-                system_prompt = (
-                    "You create concise professional summaries for internal use by employers "
-                    "and project managers. You highlight key points and avoid marketing fluff. "
-                    "You may mix Russian and English if helpful."
-                )
-
-                user_prompt = textwrap.dedent(
-                    f"""
-                    Summarize this job in 5–7 bullet points for an internal report.
-                    Focus on:
-                    - job title
-                    - location
-                    - key requirements
-                    - salary/benefits (if mentioned)
-                    - ideal candidate profile
-
-                    Job title: {job_title}
-                    City / Region: {city}
-
-                    Raw details:
-                    {raw_description}
-                    """
-                )
-
-                summary_text = call_model(system_prompt, user_prompt, max_new_tokens=250)
-                st.session_state["summary_text"] = summary_text
-
     if summary_text:
         st.markdown("#### 📄 Краткое резюме для работодателя")
         st.write(summary_text)
 
+    end_generation(in_flight)
+
+
+with tab_posts:
+    _render_posts()
+
 
 # ---------------------------
 # TAB 2: RESEARCH & INSIGHTS
 # ---------------------------
-with tab_research:
+@st.fragment
+def _render_research():
+    """Research tab. As a fragment it reruns alone when its own widgets change."""
     st.subheader("📊 Аналитика и исследования")
 
     st.info(
@@ -394,70 +1631,208 @@ with tab_research:
         "про регионы и платформы. AI вернёт краткий анализ и рекомендации."
     )
 
-    research_type = st.selectbox(
-        "Тип запроса",
-        [
-            "Интерпретация метрик / таблиц",
-            "Сравнение регионов / платформ",
-            "Общий вопрос по стратегии / трафику",
-        ],
-    )
+    in_flight = begin_tab_run()
+
+    # Same as the job post tab: only submitting the form reruns the script.
+    with st.form("research_form", clear_on_submit=False):
+        research_type = st.selectbox("Тип запроса", list(SYSTEM_PROMPTS_RESEARCH))
+        # Cheap mode needs the Batch API secrets and Google Sheets: batch results
+        # are only delivered to ResearchInsights, so without Sheets they'd be lost.
+        research_mode = st.radio(
+            "Режим",
+            ["🚀 Мгновенно", "💰 Дёшево (через 1 час)"],
+            horizontal=True,
+            disabled=not BATCH_API_BASE or gc_client is None,
+            help="Дешёвый режим доступен, если настроены Batch API и Google Sheets.",
+        )
 
-    st.markdown("#### Ваш вопрос или данные")
-    research_input = st.text_area(
-        "Опишите, что нужно. Можно вставить таблицу (копипаст), текст с результатами или задать вопрос.",
-        height=240,
-        placeholder="Примеры:\n"
-        "- 'Вот результаты по вариантам A/B/C по городам — что лучше работает и почему?'\n"
-        "- 'Какие платформы лучше для вакансий складских работников в Гамбурге vs Берлине?'\n"
-        "- 'У нас мало откликов из Киля, что можно изменить?'",
-    )
+        st.markdown("#### Ваш вопрос или данные")
+        research_input = st.text_area(
+            "Опишите, что нужно. Можно вставить таблицу (копипаст), текст с результатами или задать вопрос.",
+            height=240,
+            placeholder="Примеры:\n"
+            "- 'Вот результаты по вариантам A/B/C по городам — что лучше работает и почему?'\n"
+            "- 'Какие платформы лучше для вакансий складских работников в Гамбурге vs Берлине?'\n"
+            "- 'У нас мало откликов из Киля, что можно изменить?'",
+        )
+
+        submit = st.form_submit_button(
+            "🔍 Получить инсайты", disabled=in_flight, on_click=start_generation
+        )
 
-    if st.button("🔍 Получить инсайты"):
-        if not research_input.strip():
-            st.error("Пожалуйста, введите вопрос или данные.")
+    if submit and research_mode.startswith("💰") and has_min_input(research_input):
+        try:
+            batch_id = submit_research_batch(
+                SYSTEM_PROMPTS_RESEARCH[research_type],
+                RESEARCH_USER_TEMPLATE.format_map(SafeDict(research_input=research_input)),
+                adaptive_max_tokens(
+                    research_input, max_tokens_cap, floor=RESEARCH_TOKEN_FLOOR
+                ),
+            )
+            pending_batches().append(
+                {"id": batch_id, "question_type": research_type, "input_text": research_input}
+            )
+            notify(
+                "success",
+                "💰 Запрос отправлен в пакетную обработку. Результат появится в "
+                "ResearchInsights, когда будет готов (не закрывайте вкладку).",
+            )
+        except Exception as e:
+            notify("error", f"Ошибка при отправке пакетного запроса: {e}")
+    elif submit:
+        if not has_min_input(research_input):
+            notify("error", "Пожалуйста, введите вопрос или данные.")
         else:
             with st.spinner("Анализирую..."):
-                if research_type == "Интерпретация метрик / таблиц":
-                    system_prompt = (
-                        "Ты — аналитик по маркетингу и рекрутингу для платформы по найму рабочих. "
-                        "Ты интерпретируешь KPI, варианты объявлений и результаты по регионам. "
-                        "Отвечай кратко и по-русски, давай только практические выводы."
-                    )
-                elif research_type == "Сравнение регионов / платформ":
-                    system_prompt = (
-                        "Ты — эксперт по каналам трафика и географии. "
-                        "Сравниваешь города/регионы и платформы (Facebook, Instagram, Telegram, WhatsApp, job boards) "
-                        "с точки зрения трафика и откликов. Отвечай по-русски."
-                    )
-                else:
-                    system_prompt = (
-                        "Ты — стратег по перформанс-маркетингу в рекрутинге. "
-                        "Отвечай по-русски, давай конкретные шаги и рекомендации."
-                    )
+                user_prompt = RESEARCH_USER_TEMPLATE.format_map(
+                    SafeDict(research_input=research_input)
+                )
 
-                user_prompt = textwrap.dedent(
-                    f"""
-                    Вот мой вопрос / данные:
+                stream_box = st.empty()
+                insights = call_model(
+                    SYSTEM_PROMPTS_RESEARCH[research_type],
+                    user_prompt,
+                    max_new_tokens=adaptive_max_tokens(
+                        research_input, max_tokens_cap, floor=RESEARCH_TOKEN_FLOOR
+                    ),
+                    placeholder=stream_box,
+                )
+                stream_box.empty()
+
+            gen_history()[("research", inputs_key(research_type, research_input))] = insights
+            # Kept in session_state so the Save click (a rerun) doesn't need a new model call.
+            st.session_state["insights"] = insights
+            st.session_state["insights_request"] = (research_type, research_input)
+
+    if "insights" in st.session_state:
+        insights = st.session_state["insights"]
+        question_type, input_text = st.session_state["insights_request"]
+
+        st.markdown("#### 📌 Инсайты и рекомендации")
+        st.write(insights)
+
+        if st.button("💾 Сохранить инсайты в Google Sheets"):
+            append_research_to_sheet(
+                timestamp=_now_iso(),
+                question_type=question_type,
+                input_text=input_text,
+                insights=insights,
+            )
 
-                    {research_input}
+    end_generation(in_flight)
 
-                    Пожалуйста:
-                    1) Кратко опиши, что происходит.
-                    2) Выдели самые важные риски или возможности.
-                    3) Дай 3–5 конкретных, практических рекомендаций, что делать дальше.
-                    """
-                )
 
-                insights = call_model(system_prompt, user_prompt, max_new_tokens=500)
+@st.fragment(run_every=BATCH_POLL_S)
+def _poll_research_batches():
+    """Every BATCH_POLL_S: write finished research batches to ResearchInsights."""
+    batches = pending_batches()
+    if not batches:
+        return
 
-            st.markdown("#### 📌 Инсайты и рекомендации")
+    st.caption(f"💰 Пакетных запросов в работе: {len(batches)}")
+    for batch in list(batches):
+        try:
+            insights = fetch_batch_result(batch["id"])
+        except RuntimeError as e:
+            # Terminal status (failed / expired / cancelled) or a failed request.
+            st.error(f"Пакетный запрос {batch['id']} не выполнен: {e}")
+            batches.remove(batch)
+            continue
+        except Exception as e:
+            # Polling problem (503, timeout, ...): the batch itself may still be
+            # running, so keep it and ask again on the next tick.
+            st.warning(f"Не удалось проверить пакетный запрос {batch['id']}: {e}")
+            continue
+        if insights is None:
+            continue
+
+        batches.remove(batch)
+        gen_history()[
+            ("research", inputs_key(batch["question_type"], batch["input_text"]))
+        ] = insights
+        with st.expander(f"📌 Готово: {batch['question_type']}"):
             st.write(insights)
+        append_research_to_sheet(
+            timestamp=_now_iso(),
+            question_type=batch["question_type"],
+            input_text=batch["input_text"],
+            insights=insights,
+            sync=True,
+        )
 
-            if st.button("💾 Сохранить инсайты в Google Sheets"):
-                append_research_to_sheet(
-                    timestamp=datetime.utcnow(),
-                    question_type=research_type,
-                    input_text=research_input,
-                    insights=insights,
-                )
+
+with tab_research:
+    _render_research()
+    _poll_research_batches()
+
+
+# ---------------------------
+# SIDEBAR: SHEETS QUEUE
+# ---------------------------
+# A fragment with its own timer: it writes queued rows every FLUSH_INTERVAL_S
+# and keeps the counts current even though the tabs rerun as fragments.
+@st.fragment(run_every=FLUSH_INTERVAL_S)
+def _render_sheets_queue():
+    st.markdown("---")
+    st.markdown("**Очередь Google Sheets**")
+    queue_status = st.empty()
+
+    manual = st.button("📤 Отправить очередь в Google Sheets")
+    has_pending = any(pending_rows(name) for name in SHEET_BUFFERS)
+    if manual or (has_pending and not flush_paused()):
+        try:
+            written = sum(flush_sheet_buffer(name) for name in SHEET_BUFFERS)
+            st.session_state.pop("sheets_flush_paused_until", None)
+            if manual:
+                st.success(f"✅ Отправлено строк: {written}")
+        except Exception as e:
+            st.session_state["sheets_flush_paused_until"] = time.monotonic() + FLUSH_BACKOFF_S
+            st.session_state["sheets_flush_error"] = str(e)
+    if flush_paused():
+        st.error(
+            "Ошибка при записи в Google Sheets: "
+            f"{st.session_state.get('sheets_flush_error')}. "
+            f"Автоотправка приостановлена на {FLUSH_BACKOFF_S // 60} мин."
+        )
+
+    queue_status.write(
+        f"Объявления: {len(pending_rows(JOBPOSTS_SHEET))} · "
+        f"Инсайты: {len(pending_rows(RESEARCH_SHEET))} · "
+        f"Отклонено: {len(dead_letter_rows())}"
+    )
+
+
+with st.sidebar:
+    _render_sheets_queue()
+
+
+# ---------------------------
+# SIDEBAR: HISTORY
+# ---------------------------
+# Generations run inside the tab fragments, which don't rerun the sidebar, so
+# the count refreshes on the same timer as the Sheets queue.
+@st.fragment(run_every=FLUSH_INTERVAL_S)
+def _render_history():
+    with st.expander("История генераций"):
+        history_status = st.empty()
+        if st.button("🧹 Очистить историю"):
+            gen_history().clear()
+        history_status.write(f"Сохранено: {len(gen_history())} из {HISTORY_MAX_ITEMS}")
+
+
+with st.sidebar:
+    _render_history()
+
+
+# ---------------------------
+# SIDEBAR: CACHES
+# ---------------------------
+if st.sidebar.button("Очистить кеш"):
+    # Session-held clients are not covered by st.cache_resource.clear().
+    for client in st.session_state.pop("hf_clients", {}).values():
+        _release_client(client)
+    st.session_state.pop("gc_client", None)
+    st.cache_resource.clear()
+    st.cache_data.clear()
+    _gc.collect()
+    st.sidebar.success("Кеш очищен.")